@@ -1,9 +1,18 @@
 import streamlit as st
 import pandas as pd
 import folium
-from streamlit_folium import st_folium
+from folium.plugins import FastMarkerCluster
+import streamlit.components.v1 as components
+import pydeck as pdk
 from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
+from geopy.adapters import RequestsAdapter
+from geopy.exc import GeocoderServiceError, GeocoderTimedOut
+import concurrent.futures
+import hashlib
+import io
+import sqlite3
+import threading
+import time
 import os
 
 # 1. SET PAGE TO WIDE MODE AND INJECT FULL-WIDTH CSS
@@ -25,46 +34,199 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 SAP_FILE = 'T001W.txt'
-CACHE_FILE = 'geocoded_cache.csv'
+CACHE_FILE = 'geocoded_cache.csv'   # legacy CSV, migrated into CACHE_DB on first run
+CACHE_DB = 'geocoded_cache.db'
 
 # --- 2. DATA HELPERS ---
+# Only these T001W columns are used downstream; skipping the rest saves the
+# parse and type-inference work for the dozens of dropped columns.
+SAP_COLS = ('WERKS', 'NAME1', 'STRAS', 'PSTLZ', 'ORT01', 'LAND1')
+
 @st.cache_data
 def load_sap_data(file_path):
-    header_idx = 0
-    with open(file_path, 'r', encoding='ISO-8859-1') as f:
-        for i, line in enumerate(f):
-            if 'MANDT' in line and 'NAME1' in line:
-                header_idx = i
-                break
-    df = pd.read_csv(file_path, sep='\t', encoding='ISO-8859-1', skiprows=header_idx)
-    df.columns = df.columns.str.strip()
-    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    df = df.dropna(subset=['NAME1', 'ORT01'])
+    # Read the file once: find the header row in the raw bytes, then parse
+    # from memory instead of re-reading from disk through pandas.
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    hdr_pos = raw.find(b'MANDT')
+    header_idx = raw.count(b'\n', 0, hdr_pos) if hdr_pos != -1 else 0
+    # Reading the address columns as string up front keeps PSTLZ from being
+    # inferred as float (and growing a '.0' suffix) and skips type inference
+    # on the columns we actually use.
+    # Parse in 100k-row slices and filter inside each slice, so peak memory
+    # is bounded by one slice rather than the whole dump.
+    chunks = []
+    for chunk in pd.read_csv(io.BytesIO(raw), sep='\t', encoding='ISO-8859-1', skiprows=header_idx,
+                             usecols=lambda c: c.strip() in SAP_COLS,
+                             dtype={'NAME1': 'string', 'STRAS': 'string', 'PSTLZ': 'string',
+                                    'ORT01': 'string', 'LAND1': 'string'},
+                             chunksize=100_000):
+        chunk.columns = chunk.columns.str.strip()
+        chunks.append(chunk.dropna(subset=['NAME1', 'ORT01']))
+    df = pd.concat(chunks, copy=False)
     
-    df['Full_Address'] = (
-        df['STRAS'].fillna('').astype(str).str.strip() + ', ' + 
-        df['PSTLZ'].fillna('').astype(str).str.replace('.0', '', regex=False).str.strip() + ' ' + 
-        df['ORT01'].astype(str).str.strip() + ', ' + 
-        df['LAND1'].astype(str).str.strip()
-    )
+    # Arrow-backed strings: strip/concat run as C kernels instead of
+    # allocating a new Python str per row per step.
+    stras = df['STRAS'].astype('string[pyarrow]').fillna('').str.strip()
+    ort01 = df['ORT01'].astype('string[pyarrow]').str.strip()
+    land1 = df['LAND1'].astype('string[pyarrow]').str.strip()
+
+    pstlz = df['PSTLZ'].astype('string[pyarrow]').fillna('').str.strip()
+
+    df['Full_Address'] = stras + ', ' + pstlz + ' ' + ort01 + ', ' + land1
+
+    # Low-cardinality columns as category and PSTLZ as nullable int shrink
+    # the frame several-fold — lower session memory and a cheaper hash build
+    # in the cache merge.
+    for c in ('LAND1', 'ORT01', 'WERKS'):
+        if c in df.columns:
+            df[c] = df[c].astype('category')
+    df['PSTLZ'] = pd.to_numeric(df['PSTLZ'], errors='coerce').astype('Int32')
     return df
 
-def load_cache():
+# Bump when the Full_Address construction or the geocoding provider changes:
+# rows written under an older key are dropped on load and re-geocoded.
+CACHE_KEY_VERSION = 'v1'
+
+def _addr_key(address):
+    return hashlib.blake2b(f"{address}|{CACHE_KEY_VERSION}".encode(), digest_size=16).hexdigest()
+
+_GEO_SCHEMA = ("CREATE TABLE IF NOT EXISTS geo("
+               "addr_key TEXT PRIMARY KEY, address TEXT, lat REAL, lon REAL, "
+               "status TEXT, last_tried TIMESTAMP)")
+
+def get_cache_conn():
+    conn = sqlite3.connect(CACHE_DB)
+    conn.execute(_GEO_SCHEMA)
+    cols = [row[1] for row in conn.execute("PRAGMA table_info(geo)")]
+    # Re-key a pre-v1 table that was keyed on the raw address text
+    if 'addr_key' not in cols:
+        rows = conn.execute("SELECT address, lat, lon FROM geo").fetchall()
+        conn.execute("DROP TABLE geo")
+        conn.execute(_GEO_SCHEMA)
+        conn.executemany("INSERT OR REPLACE INTO geo VALUES (?,?,?,?,'OK',CURRENT_TIMESTAMP)",
+                         [(_addr_key(a), a, lat, lon) for a, lat, lon in rows])
+        conn.commit()
+    elif 'status' not in cols:
+        conn.execute("ALTER TABLE geo ADD COLUMN status TEXT")
+        conn.execute("ALTER TABLE geo ADD COLUMN last_tried TIMESTAMP")
+        conn.execute("UPDATE geo SET status='OK' WHERE lat IS NOT NULL")
+        conn.commit()
+    # One-time migration of the old CSV cache
     if os.path.exists(CACHE_FILE):
-        return pd.read_csv(CACHE_FILE)
-    return pd.DataFrame(columns=['Full_Address', 'lat', 'lon'])
+        legacy = pd.read_csv(CACHE_FILE).drop_duplicates('Full_Address')
+        conn.executemany("INSERT OR REPLACE INTO geo VALUES (?,?,?,?,'OK',CURRENT_TIMESTAMP)",
+                         [(_addr_key(a), a, lat, lon)
+                          for a, lat, lon in legacy[['Full_Address', 'lat', 'lon']].itertuples(index=False)])
+        conn.commit()
+        os.rename(CACHE_FILE, CACHE_FILE + '.migrated')
+    return conn
+
+def _cache_mtime():
+    return os.path.getmtime(CACHE_DB) if os.path.exists(CACHE_DB) else 0.0
+
+@st.cache_data
+def load_cache(cache_mtime):
+    # cache_mtime only busts the st.cache_data entry when the DB file changes;
+    # between geocoding runs every rerun gets the memoized frame.
+    conn = get_cache_conn()
+    try:
+        df = pd.read_sql("SELECT addr_key, address AS Full_Address, lat, lon, status, last_tried FROM geo", conn)
+    finally:
+        conn.close()
+    # Rows written under an older CACHE_KEY_VERSION fail the key check and
+    # fall out of the cache, so they show up as pending again.
+    current = df['addr_key'] == [_addr_key(a) for a in df['Full_Address']]
+    return df.loc[current, ['Full_Address', 'lat', 'lon', 'status', 'last_tried']]
+
+@st.cache_data
+def build_full_df(sap_mtime, cache_mtime):
+    sap_data = load_sap_data(SAP_FILE)
+    cache_df = load_cache(cache_mtime)
+    # Series.map against a dict is one hash-probe pass per column; the old
+    # left merge rebuilt a join index over the whole SAP frame each time.
+    addresses = cache_df['Full_Address']
+    for col in ('lat', 'lon', 'status', 'last_tried'):
+        sap_data[col] = sap_data['Full_Address'].map(dict(zip(addresses, cache_df[col])))
+    return sap_data
+
+# --- 2b. GEOCODING WORKERS ---
+# Nominatim's usage policy caps us at ~1 req/s, so keep the pool small for OSM.
+# The structure still pays off: swap in a faster provider and raise MAX_WORKERS.
+MAX_WORKERS = 2
+MIN_DELAY_SECONDS = 1.1
+
+_rate_lock = threading.Lock()
+_next_slot = [0.0]
+_worker_state = threading.local()
+
+def _wait_for_rate_slot():
+    # Shared token bucket: hands out one start time per MIN_DELAY_SECONDS
+    # across all workers, so the pool never exceeds the provider's rate cap.
+    with _rate_lock:
+        slot = max(_next_slot[0], time.monotonic())
+        _next_slot[0] = slot + MIN_DELAY_SECONDS
+    time.sleep(max(0.0, slot - time.monotonic()))
+
+class BatchGeocoder:
+    # Providers with a batch endpoint resolve ~150 addresses per HTTP call
+    # instead of one. Requires the optional `arcgis` package plus credentials
+    # in .streamlit/secrets.toml; without them Run All uses the Nominatim
+    # pool below.
+    BATCH_SIZE = 150
+
+    def __init__(self, username, password):
+        from arcgis.gis import GIS
+        from arcgis import geocoding
+        self._geocoding = geocoding
+        self._gis = GIS(username=username, password=password)
+
+    def geocode_batch(self, addresses):
+        # Returns one (lat, lon) or None per input address, in order.
+        results = self._geocoding.batch_geocode(list(addresses), out_sr=4326)
+        coords = []
+        for res in results:
+            loc = res.get('location') if res else None
+            coords.append((loc['y'], loc['x']) if loc else None)
+        return coords
+
+def _geocode_one(address, country=None):
+    # Each worker keeps its own Nominatim instance (geopy geocoders are not
+    # safe to share across threads, but one per thread is fine). RequestsAdapter
+    # keeps the TCP/TLS connection alive across calls instead of handshaking
+    # per request.
+    if not hasattr(_worker_state, 'geolocator'):
+        _worker_state.geolocator = Nominatim(user_agent="sap_global_mapper_v3",
+                                             adapter_factory=RequestsAdapter)
+    for attempt in range(3):
+        _wait_for_rate_slot()
+        try:
+            # Scoping the query to the SAP country code makes Nominatim's search
+            # cheaper and avoids cross-country false matches.
+            return address, _worker_state.geolocator.geocode(address, country_codes=country)
+        except (GeocoderTimedOut, GeocoderServiceError):
+            # Transient timeout/5xx: back off and retry instead of writing a
+            # FAIL row for an address that would have resolved.
+            time.sleep(2 ** attempt)
+    return address, None
 
 # --- 3. UI INITIALIZATION ---
 st.title("📍 SAP Global Site Monitor")
-sap_data = load_sap_data(SAP_FILE)
-cache_df = load_cache()
-
-full_df = sap_data.merge(cache_df[['Full_Address', 'lat', 'lon']], on='Full_Address', how='left')
-mapped_df = full_df.dropna(subset=['lat', 'lon'])
+full_df = build_full_df(os.path.getmtime(SAP_FILE), _cache_mtime())
+# The map only needs these four columns; don't drag the rest of T001W
+# through the rendering path (and the st.cache_data copies it implies).
+_MAP_COLS = ['NAME1', 'Full_Address', 'lat', 'lon']
+mapped_df = full_df.loc[full_df['lat'].notna(), _MAP_COLS]
 
 # Sidebar
 st.sidebar.header("Data Management")
-pending_count = len(full_df[full_df['lat'].isna()])
+# Addresses that failed recently stay skipped until the TTL passes, so
+# re-runs spend the rate budget on genuinely new addresses only.
+FAIL_RETRY_DAYS = 30
+retry_cutoff = pd.Timestamp.utcnow().tz_localize(None) - pd.Timedelta(days=FAIL_RETRY_DAYS)
+last_tried = pd.to_datetime(full_df['last_tried'], errors='coerce')
+pending_mask = full_df['lat'].isna() & ((full_df['status'] != 'FAIL') | (last_tried < retry_cutoff))
+pending_count = int(pending_mask.sum())
 st.sidebar.metric("Cached Sites", len(mapped_df))
 st.sidebar.metric("Pending Sites", pending_count)
 
@@ -77,56 +239,127 @@ if pending_count > 0:
     if st.sidebar.button("🚀 Run All Geocoding"):
         progress_bar = st.progress(0)
         status_text = st.empty()
-        geolocator = Nominatim(user_agent="sap_global_mapper_v3")
-        geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1.1)
-        
-        new_results = []
-        pending_df = full_df[full_df['lat'].isna()].copy()
-
-        for i, row in enumerate(pending_df.itertuples()):
-            status_text.text(f"Geocoding {i+1}/{len(pending_df)}: {row.NAME1}")
-            try:
-                loc = geocode(row.Full_Address)
+
+        new_count = 0
+        # Multi-plant campuses share one street address — geocode each unique
+        # string once; the merge fans the coordinates back out to all rows.
+        pending = full_df.loc[pending_mask, ['Full_Address', 'LAND1']].drop_duplicates('Full_Address')
+        conn = get_cache_conn()
+
+        try:
+            arcgis_user = st.secrets["arcgis_username"]
+            arcgis_pass = st.secrets["arcgis_password"]
+        except (KeyError, FileNotFoundError):
+            arcgis_user = arcgis_pass = None
+
+        if arcgis_user:
+            geocoder = BatchGeocoder(arcgis_user, arcgis_pass)
+            addrs = pending['Full_Address'].tolist()
+            for start in range(0, len(addrs), BatchGeocoder.BATCH_SIZE):
+                chunk = addrs[start:start + BatchGeocoder.BATCH_SIZE]
+                status_text.text(f"Batch geocoding {start + len(chunk)}/{len(addrs)}")
+                for addr, coords in zip(chunk, geocoder.geocode_batch(chunk)):
+                    if coords:
+                        conn.execute("INSERT OR REPLACE INTO geo VALUES (?,?,?,?,'OK',CURRENT_TIMESTAMP)",
+                                     (_addr_key(addr), addr, coords[0], coords[1]))
+                        new_count += 1
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO geo VALUES (?,?,NULL,NULL,'FAIL',CURRENT_TIMESTAMP)",
+                                     (_addr_key(addr), addr))
+                conn.commit()
+                progress_bar.progress((start + len(chunk)) / len(addrs))
+                if start + BatchGeocoder.BATCH_SIZE < len(addrs):
+                    time.sleep(1.0)  # 1 batch/s keeps us inside provider limits
+            conn.close()
+            st.rerun()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [executor.submit(_geocode_one, addr,
+                                       country.lower() if isinstance(country, str) else None)
+                       for addr, country in zip(pending['Full_Address'], pending['LAND1'])]
+            # Push progress to the browser every few results, not every result
+            # — each update is a websocket message and a frontend repaint.
+            PROGRESS_EVERY = 5
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                addr, loc = future.result()
+                if (i + 1) % PROGRESS_EVERY == 0 or i + 1 == len(futures):
+                    status_text.text(f"Geocoding {i+1}/{len(futures)}: {addr}")
+                    progress_bar.progress((i + 1) / len(futures))
                 if loc:
-                    new_results.append({'Full_Address': row.Full_Address, 'lat': loc.latitude, 'lon': loc.longitude})
-            except:
-                pass
-            progress_bar.progress((i + 1) / len(pending_df))
-            
-            # Auto-save every 5
-            if len(new_results) % 5 == 0 and len(new_results) > 0:
-                batch_df = pd.DataFrame(new_results)
-                pd.concat([cache_df, batch_df]).drop_duplicates('Full_Address').to_csv(CACHE_FILE, index=False)
-        
-        # Final Save and Rerun
-        if new_results:
-            batch_df = pd.DataFrame(new_results)
-            pd.concat([cache_df, batch_df]).drop_duplicates('Full_Address').to_csv(CACHE_FILE, index=False)
+                    conn.execute("INSERT OR REPLACE INTO geo VALUES (?,?,?,?,'OK',CURRENT_TIMESTAMP)",
+                                 (_addr_key(addr), addr, loc.latitude, loc.longitude))
+                    new_count += 1
+                else:
+                    # Record the miss so the next run skips this address until
+                    # the retry TTL expires.
+                    conn.execute("INSERT OR REPLACE INTO geo VALUES (?,?,NULL,NULL,'FAIL',CURRENT_TIMESTAMP)",
+                                 (_addr_key(addr), addr))
+                # Each result is flushed as it arrives, so an interrupted run
+                # never loses work.
+                conn.commit()
+
+        conn.close()
         st.rerun()
 
 # --- 5. FULL-WIDTH MAP RENDERING ---
+# Above this count Leaflet DOM markers get sluggish, so switch to a WebGL
+# scatter layer that the GPU draws in one pass.
+PYDECK_THRESHOLD = 500
+
+@st.cache_data
+def build_map_html(points_key):
+    # Reruns with unchanged data (every widget interaction) reuse the final
+    # rendered HTML string — the Map build, marker serialization and template
+    # render are all memoized along with the center scan.
+    lats = [p[0] for p in points_key]
+    lons = [p[1] for p in points_key]
+    m = folium.Map(location=[sum(lats) / len(lats), sum(lons) / len(lons)],
+                   zoom_start=3, control_scale=True)
+    FastMarkerCluster(
+        [list(p) for p in points_key],
+        callback=(
+            "function (row) {"
+            "  return L.marker([row[0], row[1]])"
+            "    .bindPopup('<b>' + row[2] + '</b><br>' + row[3])"
+            "    .bindTooltip(row[2]);"
+            "}"
+        ),
+        # Leaflet.markercluster's incremental loader: markers are inserted into
+        # the cluster index in 50ms slices so the map stays responsive while a
+        # large payload loads, and clustering turns off once zoomed in.
+        options={
+            'chunkedLoading': True,
+            'chunkInterval': 50,
+            'chunkDelay': 20,
+            'disableClusteringAtZoom': 10,
+        },
+    ).add_to(m)
+    return m.get_root().render()
+
 if not mapped_df.empty:
-    center_lat = mapped_df['lat'].mean()
-    center_lon = mapped_df['lon'].mean()
-    
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=3, control_scale=True)
-    
-    for _, r in mapped_df.iterrows():
-        folium.Marker(
-            [r.lat, r.lon], 
-            popup=f"<b>{r.NAME1}</b><br>{r.Full_Address}",
-            tooltip=r.NAME1
-        ).add_to(m)
-    
-    # 6. EXPANDED DIMENSIONS
-    # Use use_container_width=True and a larger height (e.g., 800px)
-    st_folium(
-        m, 
-        width=None,           # Setting width to None + use_container_width=True makes it fill horizontally
-        height=800,           # Increased height from 600 to 800
-        use_container_width=True, 
-        key="main_map_full_screen",
-        returned_objects=[]
-    )
+    if len(mapped_df) >= PYDECK_THRESHOLD:
+        # One fused NumPy pass for the view center instead of two Series scans
+        center_lat, center_lon = mapped_df[['lat', 'lon']].to_numpy().mean(axis=0)
+        st.pydeck_chart(pdk.Deck(
+            initial_view_state=pdk.ViewState(latitude=center_lat, longitude=center_lon, zoom=3),
+            layers=[pdk.Layer(
+                "ScatterplotLayer",
+                data=mapped_df[['lon', 'lat', 'NAME1', 'Full_Address']],
+                get_position='[lon, lat]',
+                get_radius=5000,
+                get_fill_color=[200, 30, 0, 160],
+                pickable=True,
+            )],
+            tooltip={"text": "{NAME1}\n{Full_Address}"},
+        ))
+    else:
+        # One JSON payload clustered client-side instead of N Python Marker objects
+        # (plain Folium markers stop rendering around a few thousand sites).
+        points_key = tuple(map(tuple, mapped_df[['lat', 'lon', 'NAME1', 'Full_Address']].to_numpy()))
+
+        # The map is display-only (no click callbacks into Python), so render
+        # the memoized HTML one-way instead of paying a bidirectional state
+        # sync that grows with marker count.
+        components.html(build_map_html(points_key), height=800)
 else:
     st.info("No data available. Click 'Run All' in the sidebar.")